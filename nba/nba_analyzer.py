@@ -1,71 +1,157 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import os
-import warnings
 
+import numpy as np
 import pandas as pd
-from pandas.errors import SettingWithCopyWarning
-from pandas.errors import PerformanceWarning
+import pyarrow as pa
+import pyarrow.parquet as pq
 
-warnings.simplefilter(action="ignore", category=SettingWithCopyWarning)
-warnings.simplefilter(action="ignore", category=PerformanceWarning)
+from .nba_io import read_csv
+
+# box score stats returned by the NBA API for both teams and players
+_BOX_SCORE_COLS = [
+    "FGM", "FGA", "FG3M", "FG3A", "FTM", "FTA", "OREB", "DREB", "AST", "STL",
+    "BLK", "TOV", "PF", "PTS", "PLUS_MINUS"
+]
+# box score stats fit comfortably in float32, halving memory per column
+_STATS_DTYPES = {col: np.float32 for col in _BOX_SCORE_COLS}
+# columns we want to calculate season averages for, in the order each API
+# endpoint returns them (the team game finder puts PTS right after WL)
+_PLAYER_STATS_COLS = ["WL"] + _BOX_SCORE_COLS + ["REST_DAYS"]
+_TEAM_STATS_COLS = ["WL", "PTS"] + \
+                   [col for col in _BOX_SCORE_COLS if col != "PTS"] + \
+                   ["REST_DAYS"]
+_PLAYER_AVG_COLS = [f"SEASON_AVG_{col}" for col in _PLAYER_STATS_COLS]
+_TEAM_AVG_COLS = [f"SEASON_AVG_{col}" for col in _TEAM_STATS_COLS]
+# columns we want distribution stats for, and the final distribution columns
+_DIST_STATS_COLS = [
+    col for col in _PLAYER_STATS_COLS + _PLAYER_AVG_COLS if col != "WL"
+]
+_DIST_COLS = ["GAME_ID", "HOME_GAME", "WL"] + [
+    col + suffix for col in _DIST_STATS_COLS
+    for suffix in ["_mean", "_min", "_q25", "_q50", "_q75", "_max"]
+]
+_DIST_DTYPES = {
+    **{col: np.float64 for col in _DIST_COLS},
+    "GAME_ID": str, "HOME_GAME": np.int8, "WL": np.int8
+}
+# bump when get_game_averages_df changes so cached averages are recomputed
+_CACHE_VERSION = 2
+
+
+def _load_game_averages_df(path, team=False, player=False):
+    # module-level so it can be pickled for worker processes
+    # reuse cached averages unless the CSV has changed since they were saved,
+    # or they were computed by an older version of get_game_averages_df
+    dir, file = os.path.split(path)
+    cache_path = f"{dir}/.cache/{file}.v{_CACHE_VERSION}.parquet"
+    if os.path.exists(cache_path) and \
+       os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        try:
+            df = pd.read_parquet(cache_path)
+        except (OSError, pa.ArrowInvalid):
+            # unreadable cache file, recompute it below
+            df = None
+        if team:
+            stats_cols = _TEAM_STATS_COLS + _TEAM_AVG_COLS
+        else:
+            stats_cols = _PLAYER_STATS_COLS + _PLAYER_AVG_COLS
+        if df is not None and list(df.columns[-len(stats_cols):]) == stats_cols:
+            return df
+
+    id_prefix = "TEAM" if team else "PLAYER"
+    df = read_csv(
+        path,
+        dtype={
+            "GAME_ID": str,
+            "SEASON_ID": str,
+            f"{id_prefix}_ID": str,
+            **_STATS_DTYPES
+        }
+    )
+    # get averages columns and cache them, writing to a temporary file first
+    # so an interrupted write never leaves a truncated cache file behind
+    df = NBAAnalyzer.get_game_averages_df(df, team=team, player=player)
+    os.makedirs(f"{dir}/.cache", exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    df.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, cache_path)
+    return df
 
 
 class NBAAnalyzer:
-    def __init__(self, player_games_dir, team_games_dir, analyzed_games_path):
+    """
+    Object for building model-ready data from the ingested game-level data.
+    Args:
+        player_games_dir(str):   directory used for player data
+        team_games_dir(str):     directory used for team data
+        analyzed_games_dir(str): directory of the Parquet dataset of player
+                                 distribution stats by team-game
+        analyzed_games_path(str): location of the CSV of analyzed games used
+                                 before the Parquet dataset. Still accepted
+                                 (also positionally, in place of
+                                 analyzed_games_dir, if it ends in .csv);
+                                 its rows are imported into the dataset on
+                                 the first run, and the dataset defaults to
+                                 the same path without the .csv extension.
+        max_workers(int):        number of worker processes used to load
+                                 game files; None or 1 loads them in this
+                                 process. With more than 1 worker on
+                                 platforms that start processes with spawn
+                                 (macOS, Windows), run() must be called
+                                 under an `if __name__ == "__main__":` guard.
+    """
+    def __init__(self, player_games_dir, team_games_dir,
+                 analyzed_games_dir=None, max_workers=None,
+                 analyzed_games_path=None):
+        # accept the legacy analyzed games CSV, by keyword or positionally
+        if analyzed_games_path is None and analyzed_games_dir is not None \
+           and analyzed_games_dir.endswith(".csv"):
+            analyzed_games_path, analyzed_games_dir = analyzed_games_dir, None
+        if analyzed_games_dir is None:
+            if analyzed_games_path is None:
+                raise TypeError("analyzed_games_dir is required")
+            analyzed_games_dir = os.path.splitext(analyzed_games_path)[0]
         self.player_games_dir = player_games_dir
         self.team_games_dir = team_games_dir
+        self.analyzed_games_dir = analyzed_games_dir
         self.analyzed_games_path = analyzed_games_path
+        self.max_workers = max_workers
         self.player_df = None
         self.team_df = None
         self.merged_data = None
 
-    def get_game_averages_df(self, df, team=False, player=False):
+    @staticmethod
+    def get_game_averages_df(df, team=False, player=False):
         # indicate inclusive season, win/loss column to int, home game
         df["SEASON_YEAR"] = df["SEASON_ID"].str[-4:]
-        df["WL"] = df["WL"].apply(lambda x: 1 if x=="W" else 0)
-        df["HOME_GAME"] = df["MATCHUP"].apply(lambda x: 0 if '@' in x else 1)
+        df["WL"] = (df["WL"] == "W").astype(np.int8)
+        df["HOME_GAME"] = (
+            ~df["MATCHUP"].str.contains("@", regex=False)
+        ).astype(np.int8)
         df["GAME_DATE"] = pd.to_datetime(df["GAME_DATE"])
         df = df.sort_values("GAME_DATE")
         df["REST_DAYS"] = df["GAME_DATE"].diff().dt.days.fillna(0)
 
-        # columns we want to calculate averages for
-        stats_cols = [col for col in df.columns if col not in [
-            "SEASON_ID", "TEAM_ID", "PLAYER_ID", "TEAM_ABBREVIATION",
-            "TEAM_NAME", "GAME_ID", "SEASON_YEAR", "HOME_GAME", "GAME_DATE",
-            "MATCHUP"
-        ]]
-
-        rows = []
-        for season in df["SEASON_YEAR"].unique():
-          # Get stats columns for games in the specific season
-          season_games = df[df["SEASON_YEAR"]==season][stats_cols]
-
-          # Get averages over the season
-          season_rows = [season_games.iloc[0]]
-          cumulative_row = season_games.iloc[0]
-          games_played = 1
-          for i in range(1, len(season_games)):
-              games_played += 1
-              row = season_games.iloc[i]
-              cumulative_row = cumulative_row + row
-              season_rows.append(cumulative_row / games_played)
-
-          rows += season_rows
-
-        stats_df = pd.DataFrame(rows)
-        stats_df.index = df.index
-        avg_columns = [f"SEASON_AVG_{col}" for col in stats_df.columns]
-        stats_df.columns = avg_columns
-
-        # Merge basic data from API with averages columns
-        df = df.reset_index()
-        stats_df = stats_df.reset_index()
-        stats_df = pd.merge(df, stats_df, on="index").drop(columns="index")
+        # Get running averages over each season (cumulative sum / games played)
+        season_groups = df.groupby("SEASON_YEAR", sort=False)
+        games_played = season_groups.cumcount() + 1
+        if team:
+            stats_cols, avg_cols = _TEAM_STATS_COLS, _TEAM_AVG_COLS
+        else:
+            stats_cols, avg_cols = _PLAYER_STATS_COLS, _PLAYER_AVG_COLS
+        stats_df = season_groups[stats_cols].cumsum().div(games_played, axis=0)
+        stats_df.columns = avg_cols
+
+        # Join basic data from API with averages columns
+        stats_df = pd.concat([df, stats_df], axis=1).reset_index(drop=True)
         keep_cols = []
         if team:
             keep_cols += ["TEAM_ABBREVIATION", "TEAM_ID"]
         if player:
             keep_cols += ["PLAYER_ID"]
-        keep_cols += ["GAME_ID", "HOME_GAME"] + stats_cols + avg_columns
+        keep_cols += ["GAME_ID", "HOME_GAME"] + stats_cols + avg_cols
         stats_df = stats_df[keep_cols]
 
         return stats_df
@@ -74,88 +160,114 @@ class NBAAnalyzer:
         # set formatting variables
         if team:
             dir = self.team_games_dir
-            id_prefix = "TEAM"
         elif player:
             dir = self.player_games_dir
-            id_prefix = "PLAYER"
-
-        dfs = []
-        # read all dfs
-        for i in os.listdir(dir):
-            if not i.endswith(".csv"):
-                continue
-            df = pd.read_csv(
-                f"{dir}/{i}",
-                dtype={
-                    "GAME_ID": str,
-                    "SEASON_ID": str,
-                    f"{id_prefix}_ID": str
-                }
-            )
-            # get averages columns
-            df = self.get_game_averages_df(df, team=team, player=player)
-            dfs.append(df)
-        # concat all dfs
+
+        # read all dfs and get averages columns, in worker processes if set
+        paths = [f"{dir}/{i}" for i in os.listdir(dir) if i.endswith(".csv")]
+        load = partial(_load_game_averages_df, team=team, player=player)
+        if self.max_workers is None or self.max_workers <= 1:
+            dfs = list(map(load, paths))
+        else:
+            # send files in batches (about 4 per worker) to cut per-task
+            # pickling overhead while still balancing uneven file sizes
+            chunksize = max(1, len(paths) // (self.max_workers * 4))
+            with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+                dfs = list(executor.map(load, paths, chunksize=chunksize))
+        # concat all dfs, storing IDs as categories so groupbys and merges
+        # hash integer codes rather than strings
         df = pd.concat(dfs)
+        df = df.astype({
+            col: "category" for col in ["TEAM_ID", "PLAYER_ID", "GAME_ID"]
+            if col in df.columns
+        })
 
         if team:
             self.team_df = df
         elif player:
             self.player_df = df
 
-    def update_player_df(self):
-        # columns we don't want stats for
-        exclude_cols = ['PLAYER_ID', 'GAME_ID', 'HOME_GAME', 'WL']
-        stats_cols = [col for col in self.player_df.columns if col not in exclude_cols]
-        # columns we want in the final distribution dataframe
-        dist_cols = ["GAME_ID", "HOME_GAME", "WL"]
-        for col in stats_cols:
-            for suffix in ["_mean", "_min", "_q25", "_q50", "_q75", "_max"]:
-                dist_cols.append(col+suffix)
+    def has_analyzed_games(self):
+        return os.path.isdir(self.analyzed_games_dir) and \
+               len(os.listdir(self.analyzed_games_dir)) > 0
+
+    def import_analyzed_games_csv(self):
+        # copy analyzed games from the legacy CSV into the Parquet dataset
+        df = read_csv(self.analyzed_games_path, dtype={"GAME_ID": str})
+        df = df.reindex(columns=_DIST_COLS).astype(_DIST_DTYPES)
+        if len(df):
+            pq.write_to_dataset(
+                pa.Table.from_pandas(df, preserve_index=False),
+                root_path=self.analyzed_games_dir,
+                compression="zstd"
+            )
 
+    def update_player_df(self):
+        # on the first run with a legacy CSV, carry its history over
+        if not self.has_analyzed_games() and \
+           self.analyzed_games_path is not None and \
+           os.path.exists(self.analyzed_games_path):
+            self.import_analyzed_games_csv()
         # load previously analyzed games
-        analyzed_games_df = pd.read_csv(
-            self.analyzed_games_path,
-            dtype={"GAME_ID": str}
-        )
-        # check which games need to be analyzed
-        game_ids = set(self.player_df["GAME_ID"].unique()) - \
-                   set(analyzed_games_df["GAME_ID"].unique())
-
-        # add newly analyzed games to the list
-        dfs = [analyzed_games_df]
-        for game_id in game_ids:
-            # get only the data for this particular game
-            game_df = self.player_df[self.player_df["GAME_ID"] == game_id]
-            # separate the teams
-            df_home = game_df[game_df["HOME_GAME"] == 1]
-            df_away = game_df[game_df["HOME_GAME"] == 0]
-            # for each team, get distribution stats and append row to dfs
-            for team_df in [df_home, df_away]:
-                for col in stats_cols:
-                    team_df[col+"_mean"] = team_df[col].mean()
-                    team_df[col+"_min"] = team_df[col].min()
-                    team_df[col+"_q25"] = team_df[col].quantile(0.25)
-                    team_df[col+"_q50"] = team_df[col].quantile(0.5)
-                    team_df[col+"_q75"] = team_df[col].quantile(0.75)
-                    team_df[col+"_max"] = team_df[col].max()
-                team_df = team_df[dist_cols].drop_duplicates()
-                dfs.append(team_df)
-        # concat into updated analyzed games dataframe and save
-        df = pd.concat(dfs)
-        df.to_csv(self.analyzed_games_path, index=False)
+        if self.has_analyzed_games():
+            analyzed_games_df = pd.read_parquet(self.analyzed_games_dir)
+        else:
+            # nothing analyzed yet, start from an empty dataframe whose key
+            # dtypes match the newly analyzed games and the team data
+            analyzed_games_df = pd.DataFrame(columns=_DIST_COLS) \
+                                  .astype(_DIST_DTYPES)
+        # get only the data for the games that need to be analyzed (in one
+        # hashed pass over the game IDs) and group by team-game (home/away
+        # team within each game)
+        analyzed = self.player_df["GAME_ID"].isin(analyzed_games_df["GAME_ID"])
+        new_df = self.player_df[~analyzed]
+        team_games = new_df.groupby(
+            ["GAME_ID", "HOME_GAME", "WL"], observed=True
+        )[_DIST_STATS_COLS]
+        # for each team-game, get distribution stats (min and max are the
+        # 0 and 1 quantiles, so all order stats come from one sorted pass)
+        mean_df = team_games.mean().add_suffix("_mean")
+        quantiles = {0: "min", 0.25: "q25", 0.5: "q50", 0.75: "q75", 1: "max"}
+        quantile_df = team_games.quantile(list(quantiles)).unstack(level=-1)
+        quantile_df.columns = [
+            f"{col}_{quantiles[q]}" for col, q in quantile_df.columns
+        ]
+        new_df = pd.concat([mean_df, quantile_df], axis=1).reset_index()
+
+        # save only the newly analyzed games, as a new file in the dataset
+        new_df = new_df.reindex(columns=_DIST_COLS).astype(_DIST_DTYPES)
+        if len(new_df):
+            pq.write_to_dataset(
+                pa.Table.from_pandas(new_df, preserve_index=False),
+                root_path=self.analyzed_games_dir,
+                compression="zstd"
+            )
+        # concat into updated analyzed games dataframe, leaving out empty
+        # dataframes so they don't turn the columns into object dtype; with
+        # nothing to concat, keep the (typed) previously analyzed games
+        parts = [part for part in [analyzed_games_df, new_df] if len(part)]
+        df = pd.concat(parts) if parts else analyzed_games_df
         self.player_df = df
 
     def clean_and_merge_dfs(self):
         # ensure we only get games with data for the home and away teams
-        game_id_counts = self.team_df.groupby('GAME_ID')['GAME_ID'].transform('count')
-        df = self.team_df[game_id_counts == 2]
-        # merge teams with players
-        df = pd.merge(df, self.player_df, on=["GAME_ID", "HOME_GAME", "WL"])
+        game_id_counts = self.team_df["GAME_ID"].value_counts()
+        complete_game_ids = game_id_counts.index[game_id_counts == 2]
+        df = self.team_df[self.team_df["GAME_ID"].isin(complete_game_ids)]
+        # merge teams with players, on game IDs sharing the same categories
+        game_id_dtype = pd.CategoricalDtype(np.union1d(
+            df["GAME_ID"].unique(), self.player_df["GAME_ID"].unique()
+        ))
+        player_df = self.player_df.astype({"GAME_ID": game_id_dtype})
+        df = df.astype({"GAME_ID": game_id_dtype})
+        df = pd.merge(df, player_df, on=["GAME_ID", "HOME_GAME", "WL"])
         # separate prev and curr home game features and create target column
+        # (rows are already sorted by team, so skip sorting the group keys)
         df = df.sort_values(by=["TEAM_ID","GAME_ID"])
         df[["GAME_ID_JOIN", "HOME_GAME_CURR", "WL_PRED"]] = \
-            df.groupby("TEAM_ID")[["GAME_ID", "HOME_GAME", "WL"]].shift(-1)
+            df.groupby("TEAM_ID", sort=False, observed=True) \
+              [["GAME_ID", "HOME_GAME", "WL"]] \
+              .shift(-1)
         # split into home and away dfs
         home_df = df[df["HOME_GAME"]==1]
         away_df = df[df["HOME_GAME"]==0]
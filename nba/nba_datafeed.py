@@ -1,4 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 import os
+import threading
+import time
 
 from nba_api.stats.endpoints import boxscoretraditionalv2
 from nba_api.stats.endpoints import leaguegamefinder
@@ -6,6 +9,8 @@ from nba_api.stats.endpoints import playergamelog
 from nba_api.stats.static import teams
 import pandas as pd
 
+from .nba_io import read_csv
+
 
 class NBADataFeed:
     """
@@ -15,11 +20,40 @@ class NBADataFeed:
         team_games_dir(str):         directory used for team data
         preexisting_games_path(str): path for data used to check which games
                                      need to be updated for player datasets
+        max_workers(int):            number of concurrent API calls
+        request_interval(float):     minimum seconds between the start of
+                                     consecutive API calls, to stay under
+                                     the NBA API's rate limits. This caps
+                                     throughput at 1/request_interval calls
+                                     per second regardless of max_workers.
+                                     Defaults to 0.5; pass None to turn the
+                                     spacing off (not recommended against
+                                     stats.nba.com).
     """
-    def __init__(self, player_games_dir, team_games_dir, preexisting_games_path):
+    def __init__(self, player_games_dir, team_games_dir, preexisting_games_path,
+                 max_workers=6, request_interval=0.5):
         self.player_games_dir = player_games_dir
         self.team_games_dir = team_games_dir
         self.preexisting_games_path = preexisting_games_path
+        self.max_workers = max_workers
+        self.request_interval = request_interval
+        self._request_lock = threading.Lock()
+        self._last_request_time = 0.0
+
+    def wait_for_request_slot(self):
+        """Block until the next API call is allowed by the rate limit."""
+        if self.request_interval is None:
+            return
+        # reserve the next start slot under the lock, then sleep outside it
+        with self._request_lock:
+            slot = max(
+                time.monotonic(),
+                self._last_request_time + self.request_interval
+            )
+            self._last_request_time = slot
+        wait = slot - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
 
     def get_team_games(self, team_id):
         """
@@ -30,36 +64,50 @@ class NBADataFeed:
             df(DataFrame): dataframe of game-level stats
         """
         # API call
+        self.wait_for_request_slot()
         game_finder = leaguegamefinder.LeagueGameFinder(
             team_id_nullable=team_id
         )
-        # Get team game stats, drop nulls, sort by game date, drop unneeded data
-        df = game_finder.get_data_frames()[0] \
-                        .dropna() \
-                        .sort_values("GAME_DATE") \
-                        .drop(columns=[
-                            'FG3_PCT', 'FG_PCT', 'FT_PCT', 'MIN', 'REB'
-                        ])
+        # Get team game stats, drop nulls and unneeded data in a single
+        # selection, sort by game date
+        df = game_finder.get_data_frames()[0]
+        keep_cols = [col for col in df.columns if col not in [
+            'FG3_PCT', 'FG_PCT', 'FT_PCT', 'MIN', 'REB'
+        ]]
+        df = df.loc[df.notna().all(axis=1), keep_cols] \
+               .sort_values("GAME_DATE", kind="stable")
         return df
 
     def get_all_team_games(self):
         """Create/update game-level datasets for all current NBA teams."""
-        # Get a dataset of all teams
-        nba_teams = pd.DataFrame(teams.get_teams())
-        nba_teams.columns = [f"team_{col}" for col in nba_teams.columns]
-
-        # For each team, build a game-level dataset
-        for i in range(len(nba_teams)):
-            row = nba_teams.iloc[i]
-            team_id = row["team_id"]
-            df = self.get_team_games(team_id)
-            path = f"{self.player_games_dir}/{df.iloc[0]['TEAM_ID']}.csv"
-            # Check if we have existing data that we can add to and deduplicate
-            if os.path.exists(path):
-                old_df = pd.read_csv(path)
-                df = pd.concat([old_df, df]).drop_duplicates()
-            # Save the data
-            df.to_csv(path, index=False)
+        # Get the IDs of all teams
+        team_ids = [team["id"] for team in teams.get_teams()]
+
+        # For each team, build a game-level dataset, fetching concurrently
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            dfs = executor.map(self.get_team_games, team_ids)
+            for df in dfs:
+                self.save_team_games(df)
+
+    def save_team_games(self, df):
+        """
+        Merge a team's game-level stats with any existing data and save it.
+        Args:
+            df(DataFrame): dataframe of game-level stats for one team
+        """
+        path = f"{self.player_games_dir}/{df.iloc[0]['TEAM_ID']}.csv"
+        # Check if we have existing data that we can add to and deduplicate
+        if os.path.exists(path):
+            old_df = read_csv(
+                path,
+                dtype={'GAME_ID': str, 'SEASON_ID': str, 'GAME_DATE': str}
+            )
+            # a game ID appears once per dataset, so dedupe on it alone
+            # (keeping the freshly fetched row) rather than whole rows
+            df = pd.concat([old_df, df]) \
+                   .drop_duplicates(subset="GAME_ID", keep="last")
+        # Save the data
+        df.to_csv(path, index=False)
 
     def get_all_games(self):
         """
@@ -70,11 +118,14 @@ class NBADataFeed:
         # Iterate through current team datasets to get all game IDs
         dfs = []
         for i in os.listdir(self.team_games_dir):
+            if not i.endswith(".csv"):
+                continue
             # keep only the game IDs
             dfs.append(
-                pd.read_csv(
+                read_csv(
                     self.team_games_dir+i,
-                    dtype={'GAME_ID': str}
+                    dtype={'GAME_ID': str},
+                    usecols=['GAME_ID']
                 )["GAME_ID"])
         df = pd.concat(dfs).drop_duplicates()
         return df
@@ -87,7 +138,7 @@ class NBADataFeed:
         """
         # get all games, keep only those that weren't in the preexisting data
         all_games = self.get_all_games()
-        preexisting_games = pd.read_csv(
+        preexisting_games = read_csv(
             self.preexisting_games_path,
             dtype={'GAME_ID': str}
         )
@@ -102,7 +153,7 @@ class NBADataFeed:
         Args:
             update_df(DataFrame): dataset to use for update
         """
-        preexisting_games = pd.read_csv(
+        preexisting_games = read_csv(
             self.preexisting_games_path,
             dtype={'GAME_ID': str}
         )
@@ -118,6 +169,7 @@ class NBADataFeed:
             player_ids(list): list of IDs for players in the game
         """
         # Fetch the boxscore data for the specified game
+        self.wait_for_request_slot()
         boxscore = boxscoretraditionalv2.BoxScoreTraditionalV2(game_id=game_id)
         player_ids = boxscore.get_data_frames()[0]["PLAYER_ID"].values.tolist()
         return player_ids
@@ -131,22 +183,22 @@ class NBADataFeed:
             df(DataFrame): dataframe of game-level stats
         """
         # Fetch player game log data
+        self.wait_for_request_slot()
         game_log = playergamelog.PlayerGameLog(
             player_id=player_id, season="ALL"
         )
-        # Get player game stats, drop nulls, sort by game date,
-        # drop unneeded data, and rename columns
-        df = game_log.get_data_frames()[0] \
-                     .dropna() \
-                     .sort_values("GAME_DATE") \
-                     .drop(columns=[
-                         'FG3_PCT', 'FG_PCT', 'FT_PCT',
-                         'MIN', 'REB', 'VIDEO_AVAILABLE'
-                     ]) \
-                     .rename(columns={
-                         "Player_ID":"PLAYER_ID",
-                         "Game_ID":"GAME_ID"
-                     })
+        # Get player game stats, drop nulls and unneeded data in a single
+        # selection, sort by game date, and rename columns
+        df = game_log.get_data_frames()[0]
+        keep_cols = [col for col in df.columns if col not in [
+            'FG3_PCT', 'FG_PCT', 'FT_PCT', 'MIN', 'REB', 'VIDEO_AVAILABLE'
+        ]]
+        df = df.loc[df.notna().all(axis=1), keep_cols] \
+               .sort_values("GAME_DATE", kind="stable") \
+               .rename(columns={
+                   "Player_ID":"PLAYER_ID",
+                   "Game_ID":"GAME_ID"
+               })
         # ensure player ID is present
         if "PLAYER_ID" not in df.columns:
             df["PLAYER_ID"] = str(player_id)
@@ -163,27 +215,46 @@ class NBADataFeed:
         Args:
             players_ids(set): IDs of players whose data needs updating
         """
-        # For each player, build a game-level dataset
-        for player_id in player_ids:
-            player_id = str(player_id)
-            df = self.get_player_games(player_id)
-            if len(df) == 0:
-                continue
-            path = f"{self.player_games_dir}/{player_id}.csv"
-            # Check if we have existing data that we can add to and deduplicate
-            if os.path.exists(path):
-                old_df = pd.read_csv(path)
-                df = pd.concat([old_df, df]).drop_duplicates()
-            df.to_csv(path, index=False)
+        # For each player, build a game-level dataset, fetching concurrently
+        player_ids = [str(player_id) for player_id in player_ids]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            dfs = executor.map(self.get_player_games, player_ids)
+            for player_id, df in zip(player_ids, dfs):
+                self.save_player_games(player_id, df)
+
+    def save_player_games(self, player_id, df):
+        """
+        Merge a player's game-level stats with any existing data and save it.
+        Args:
+            player_id(str): the ID of the player whose data to save
+            df(DataFrame):  dataframe of game-level stats for the player
+        """
+        if len(df) == 0:
+            return
+        path = f"{self.player_games_dir}/{player_id}.csv"
+        # Check if we have existing data that we can add to and deduplicate
+        if os.path.exists(path):
+            old_df = read_csv(
+                path,
+                dtype={'GAME_ID': str, 'SEASON_ID': str, 'GAME_DATE': str}
+            )
+            # a game ID appears once per dataset, so dedupe on it alone
+            # (keeping the freshly fetched row) rather than whole rows
+            df = pd.concat([old_df, df]) \
+                   .drop_duplicates(subset="GAME_ID", keep="last")
+        df.to_csv(path, index=False)
 
     def update_player_games(self):
         """Update all player game-level datasets."""
         # get game IDs to use for updates
         games_to_update = self.player_games_to_update()
-        # get unique player IDs from all games
-        player_ids = set()
-        for game_id in games_to_update["GAME_ID"].values:
-            player_ids.update(self.get_player_ids_by_game(game_id))
+        # get unique player IDs from all games, fetching concurrently
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            player_id_lists = executor.map(
+                self.get_player_ids_by_game,
+                games_to_update["GAME_ID"].tolist()
+            )
+            player_ids = set().union(*player_id_lists)
         # update all player datasets
         self.get_all_player_games(player_ids)
         # overwrite preexisting games file
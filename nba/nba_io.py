@@ -0,0 +1,28 @@
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv
+
+
+def read_csv(path, dtype=None, usecols=None):
+    """
+    Read a CSV into a dataframe using pyarrow's multithreaded parser.
+    Args:
+        path(str):      path of the CSV to read
+        dtype(dict):    column types, applied while parsing so that string
+                        IDs (e.g. GAME_ID) keep their leading zeros
+        usecols(list):  columns to read, all columns if None
+    Returns:
+        df(DataFrame): dataframe of the CSV data
+    """
+    column_types = {
+        col: pa.from_numpy_dtype(np.dtype(col_type))
+        for col, col_type in (dtype or {}).items()
+    }
+    table = csv.read_csv(
+        path,
+        convert_options=csv.ConvertOptions(
+            column_types=column_types,
+            include_columns=usecols
+        )
+    )
+    return table.to_pandas()